@@ -3,23 +3,48 @@ Invoice Processing System using Gemini API (Free Tier)
 Processes invoice images, extracts data, and categorizes them automatically.
 """
 
+import io
 import os
 import sys
 import time
-import json
+import asyncio
+import base64
 import csv
+import hashlib
+import itertools
+import random
+import re
+import shelve
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
-from typing import List, Dict, Optional
-import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted
+from queue import SimpleQueue
+from typing import Deque, List, Dict, Optional, Set, Tuple, Union
+import cv2
+import httpx
+import msgspec
+import numpy as np
+import orjson
+from google.api_core import exceptions as api_exceptions
+from google.api_core.exceptions import InternalServerError, ServiceUnavailable, TooManyRequests
 from PIL import Image
-from datetime import datetime
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from datetime import datetime, timedelta
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 
 # Fix Unicode encoding issues on Windows
 if sys.platform == 'win32':
-    import io
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
@@ -29,6 +54,130 @@ load_dotenv()
 # Logging will be configured after output folder is created
 logger = logging.getLogger(__name__)
 
+# Body of a JSON string, allowing escaped characters
+_JSON_STR = r'(?:[^"\\]|\\.)*'
+
+# Fast path for responses that follow the prompt's schema in order
+INVOICE_RE = re.compile(
+    rf'"invoice_number":\s*"(?P<invoice_number>{_JSON_STR})".*?'
+    rf'"date":\s*"(?P<date>{_JSON_STR})".*?'
+    rf'"seller":\s*"(?P<seller>{_JSON_STR})".*?'
+    rf'"client":\s*"(?P<client>{_JSON_STR})".*?'
+    rf'"category":\s*"(?P<category>{_JSON_STR})".*?'
+    rf'"confidence":\s*"(?P<confidence>{_JSON_STR})".*?'
+    rf'"items_found":\s*\[(?P<items_found>(?:\s*"{_JSON_STR}"\s*,?)*)\s*\].*?'
+    rf'"reasoning":\s*"(?P<reasoning>{_JSON_STR})".*?'
+    rf'"total_amount":\s*(?:"(?P<total_amount>{_JSON_STR})"|(?P<total_amount_num>-?[\d.]+))',
+    re.DOTALL
+)
+ITEM_RE = re.compile(rf'"({_JSON_STR})"')
+
+
+def _unescape(value: str) -> str:
+    """Decode JSON escape sequences in a string matched by INVOICE_RE"""
+    if '\\' not in value:
+        return value
+    return orjson.loads(f'"{value}"')
+
+
+class InvoiceRecord(msgspec.Struct):
+    """Fields extracted from one invoice, validated as the response is decoded"""
+    invoice_number: str
+    date: str
+    seller: str
+    client: str
+    category: str
+    confidence: str
+    items_found: List[str]
+    reasoning: str
+    total_amount: str
+    invoice_file: str = ''
+
+
+class _InvoiceJSON(InvoiceRecord):
+    """InvoiceRecord as decoded from JSON, keeping total_amount's source text"""
+    total_amount: msgspec.Raw
+
+    def to_record(self) -> InvoiceRecord:
+        """
+        Convert to an InvoiceRecord
+
+        A bare number keeps the digits Gemini wrote (1200 stays "1200", not
+        "1200.0"), matching what INVOICE_RE extracts for the same response.
+        """
+        # Also rejects anything other than a string or number
+        amount = msgspec.json.decode(self.total_amount, type=Union[str, int, float])
+        fields = msgspec.structs.asdict(self)
+        fields['total_amount'] = amount if isinstance(amount, str) else bytes(self.total_amount).decode()
+        return InvoiceRecord(**fields)
+
+
+class GeminiRateLimiter:
+    """Sliding-window limiter for Gemini's RPM, TPM and RPD quotas"""
+
+    def __init__(self,
+                 requests_per_minute: int,
+                 tokens_per_minute: int,
+                 requests_per_day: int,
+                 safety_margin: float = 0.9):
+        """
+        Initialize the rate limiter
+
+        Args:
+            requests_per_minute: Requests allowed per rolling minute
+            tokens_per_minute: Tokens allowed per rolling minute
+            requests_per_day: Requests allowed per rolling day
+            safety_margin: Fraction of each limit to actually use
+        """
+        # (window length in seconds, usable limit, [(timestamp, amount), ...])
+        self.rpm = (60, requests_per_minute * safety_margin, deque())
+        self.tpm = (60, tokens_per_minute * safety_margin, deque())
+        self.rpd = (86400, requests_per_day * safety_margin, deque())
+        # Shared by worker threads in process_all_threaded
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _wait_time(window: Tuple[int, float, Deque[Tuple[float, int]]], amount: int, now: float) -> float:
+        """Drop expired entries and return how long until `amount` fits in the window"""
+        length, limit, entries = window
+        while entries and entries[0][0] <= now - length:
+            entries.popleft()
+        if entries and sum(n for _, n in entries) + amount > limit:
+            return entries[0][0] + length - now
+        return 0.0
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        """Claim a slot for one request if it fits, otherwise return how long to wait"""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self._wait_time(self.rpm, 1, now),
+                self._wait_time(self.tpm, estimated_tokens, now),
+                self._wait_time(self.rpd, 1, now),
+            )
+            if wait <= 0:
+                self.rpm[2].append((now, 1))
+                self.tpm[2].append((now, estimated_tokens))
+                self.rpd[2].append((now, 1))
+            return wait
+
+    async def acquire(self, estimated_tokens: int):
+        """Wait until one more request of `estimated_tokens` fits in every window"""
+        while (wait := self._reserve(estimated_tokens)) > 0:
+            logger.info(f"[WAIT] Rate limit reached, waiting {wait:.1f}s...")
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self, estimated_tokens: int):
+        """Same as acquire, blocking the calling thread instead of awaiting"""
+        while (wait := self._reserve(estimated_tokens)) > 0:
+            logger.info(f"[WAIT] Rate limit reached, waiting {wait:.1f}s...")
+            time.sleep(wait)
+
+    def record(self, actual_tokens: int, estimated_tokens: int):
+        """Correct the token window once the real usage of a request is known"""
+        with self._lock:
+            self.tpm[2].append((time.monotonic(), actual_tokens - estimated_tokens))
+
 
 class InvoiceProcessor:
     """Process invoices using Gemini Vision API"""
@@ -48,12 +197,55 @@ class InvoiceProcessor:
         "Other"
     ]
 
+    # Fields extracted from each Gemini response
+    INVOICE_FIELDS = (
+        'invoice_number', 'date', 'seller', 'client', 'category',
+        'confidence', 'items_found', 'reasoning', 'total_amount'
+    )
+
+    # CSV columns
+    CSV_FIELDS = ('invoice_file',) + INVOICE_FIELDS
+
+    # Gemini REST API
+    MODEL_NAME = 'gemini-2.5-flash'
+    API_BASE_URL = 'https://generativelanguage.googleapis.com'
+    REQUEST_TIMEOUT = 120
+    MAX_KEEPALIVE_CONNECTIONS = 20
+
     # Gemini API rate limits for free tier
     REQUESTS_PER_MINUTE = 15
-    DELAY_BETWEEN_REQUESTS = 60 / REQUESTS_PER_MINUTE  # ~4 seconds
+    TOKENS_PER_MINUTE = 1_000_000
+    REQUESTS_PER_DAY = 1500
+
+    # Longest image side sent to Gemini; larger scans are tiled into extra
+    # vision tokens without making the text any more legible
+    MAX_IMAGE_DIM = 1568
+    JPEG_QUALITY = 80
+
+    # Token budget reserved for the image and the response of each request
+    IMAGE_TOKEN_ESTIMATE = 1500
+
+    # Layout used when several invoices are packed into one image
+    GRID_COLUMNS = 2
+    GRID_PADDING = 5
+
+    # Transient API errors worth retrying, with exponential backoff
+    # (TooManyRequests is what HTTP 429 maps to; ResourceExhausted subclasses it)
+    RETRYABLE_ERRORS = (TooManyRequests, ServiceUnavailable, InternalServerError, httpx.TransportError)
+    MAX_RETRIES = 5
+    MAX_RETRY_DELAY = 60
+
+    # Batch API settings
+    BATCH_MIN_FILES = 10  # below this, the regular mode finishes sooner
+    BATCH_MAX_BYTES = 20 * 1024 * 1024  # inline request size limit per batch
+    BATCH_ENVELOPE_BYTES = 1024  # room for the job's own JSON around its requests
+    BATCH_POLL_INTERVAL = 60
+
+    # Concurrent in-flight requests per API key
+    CONCURRENCY = REQUESTS_PER_MINUTE
 
     def __init__(self,
-                 api_key: str,
+                 api_keys: List[str],
                  input_folder: str = "invoices",
                  output_folder: str = "output"):
 
@@ -61,11 +253,14 @@ class InvoiceProcessor:
         Initialize the invoice processor
 
         Args:
-            api_key: Google Gemini API key
+            api_keys: Google Gemini API keys; requests are spread round-robin
+                across them, each with its own rate limits
             input_folder: Folder containing invoice images
             output_folder: Folder for output files
         """
-        self.api_key = api_key
+        if not api_keys:
+            raise ValueError("At least one Gemini API key is required")
+        self.api_keys = list(api_keys)
 
         # Convert to absolute paths relative to script location
         script_dir = Path(__file__).parent
@@ -90,31 +285,75 @@ class InvoiceProcessor:
             ],
             force=True
         )
+        # httpx logs every request at INFO, which would repeat each invoice's status
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+
+        # Configure Gemini: one rate limiter per key, and an HTTP/2 client
+        # shared by all workers while a run is in progress
+        self.limiters = [
+            GeminiRateLimiter(self.REQUESTS_PER_MINUTE, self.TOKENS_PER_MINUTE, self.REQUESTS_PER_DAY)
+            for _ in self.api_keys
+        ]
+        self._http = None
+        self._http_sync = None
+        self._rr = itertools.cycle(range(len(self.api_keys)))
+        self._backoff = wait_random_exponential(multiplier=1, max=self.MAX_RETRY_DELAY)
 
-        # Configure Gemini
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        # The prompt only depends on CATEGORIES, so build it once
+        self._prompt = self.get_prompt()
+        self._grid_prompts = {}
+        # Token estimate per request (roughly 4 characters per prompt token)
+        self._estimated_tokens = len(self._prompt) // 4 + self.IMAGE_TOKEN_ESTIMATE
 
         # Progress tracking
         self.processed_count = 0
         self.failed_count = 0
-        self.results = []
 
         # Resume capability
-        self.progress_file = self.output_folder / "progress.json"
+        self.progress_file = self.output_folder / "progress.jsonl"
+        self.batches_file = self.output_folder / "batches.json"  # submitted, not yet collected
         self.output_csv = self.output_folder / "invoice_data.csv"
+        self._csv = None  # DictWriter, open while a run is in progress
+        self._csv_file = None
+
+        # Results keyed by image content hash, so duplicate scans skip the API
+        self.cache_file = self.output_folder / "result_cache"
+        self._cache = None
+        self.cached_count = 0
 
         logger.info("Invoice Processor initialized")
         logger.info(f"Input folder: {self.input_folder}")
         logger.info(f"Output folder: {self.output_folder}")
 
-    def get_prompt(self) -> str:
-        """Get the analysis prompt for Gemini"""
+    def get_prompt(self, count: int = 1, rows: int = 1, cols: int = 1) -> str:
+        """
+        Get the analysis prompt for Gemini
+
+        Args:
+            count: Number of invoices in the image
+            rows: Grid rows the invoices are arranged in (when count > 1)
+            cols: Grid columns the invoices are arranged in (when count > 1)
+        """
         categories_list = "\n   - ".join(self.CATEGORIES)
 
+        if count == 1:
+            intro = "Analyze this invoice image and:"
+            response_format = "Provide your response in this EXACT JSON format"
+            open_array = close_array = ""
+            respond_only = "Respond ONLY with valid JSON, no additional text."
+        else:
+            intro = f"""This image contains {count} separate invoices arranged in a grid of {rows} row(s) by {cols} column(s), separated by white space.
+Number them in reading order: left to right, then top to bottom.
+
+Analyze EACH invoice and:"""
+            response_format = f"Provide your response as a JSON array of exactly {count} objects, one per invoice in reading order, each in this EXACT format"
+            open_array = "[\n"
+            close_array = ",\n  ...\n]"
+            respond_only = "Respond ONLY with a valid JSON array, no additional text."
+
         return f"""You are an invoice categorization assistant.
 
-Analyze this invoice image and:
+{intro}
 
 1. Extract key information:
    - Invoice number
@@ -127,8 +366,8 @@ Analyze this invoice image and:
 2. Categorize this invoice into ONE of these categories:
    - {categories_list}
 
-3. Provide your response in this EXACT JSON format (no markdown, no code blocks, just pure JSON):
-{{
+3. {response_format} (no markdown, no code blocks, just pure JSON):
+{open_array}{{
   "invoice_number": "extracted number",
   "date": "MM/DD/YYYY",
   "seller": "seller name",
@@ -138,141 +377,691 @@ Analyze this invoice image and:
   "items_found": ["item 1", "item 2", "item 3"],
   "reasoning": "brief explanation of why this category was chosen",
   "total_amount": "numeric value only"
-}}
+}}{close_array}
 
 Base your categorization primarily on the description of goods/services in the invoice, not just the vendor name.
-Respond ONLY with valid JSON, no additional text."""
+{respond_only}"""
+
+    def _encode_image(self, image_path: Path) -> bytes:
+        """
+        Downscale and recompress an invoice image before upload
+
+        Args:
+            image_path: Path to the invoice image
+
+        Returns:
+            Grayscale JPEG bytes no larger than MAX_IMAGE_DIM on either side
+        """
+        return self._imencode(self._load_image(image_path))
+
+    def _load_image(self, image_path: Path) -> np.ndarray:
+        """
+        Decode an invoice image as grayscale, shrunk to fit MAX_IMAGE_DIM
+
+        Args:
+            image_path: Path to the invoice image
+
+        Returns:
+            Grayscale image array no larger than MAX_IMAGE_DIM on either side
+        """
+        # Image.open only parses the header, which is enough to pick the
+        # largest libjpeg DCT reduction that still covers MAX_IMAGE_DIM
+        with Image.open(image_path) as img:
+            longest = max(img.size)
+        flag = cv2.IMREAD_GRAYSCALE
+        for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                                     (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                     (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if longest // factor >= self.MAX_IMAGE_DIM:
+                flag = reduced_flag
+                break
+
+        # np.fromfile + imdecode also copes with non-ASCII paths on Windows
+        img = cv2.imdecode(np.fromfile(str(image_path), dtype=np.uint8), flag)
+        if img is None:
+            # Formats this OpenCV build cannot decode (e.g. GIF)
+            return self._load_image_pil(image_path)
+
+        return self._fit(img, self.MAX_IMAGE_DIM, self.MAX_IMAGE_DIM)
+
+    def _load_image_pil(self, image_path: Path) -> np.ndarray:
+        """Pillow fallback for _load_image"""
+        with Image.open(image_path) as img:
+            img.thumbnail((self.MAX_IMAGE_DIM, self.MAX_IMAGE_DIM), Image.LANCZOS)
+            return np.asarray(img.convert("L"))
+
+    @staticmethod
+    def _fit(img: np.ndarray, max_w: int, max_h: int) -> np.ndarray:
+        """Shrink an image to fit within max_w x max_h, keeping its aspect ratio"""
+        h, w = img.shape[:2]
+        scale = min(max_w / w, max_h / h)
+        if scale >= 1:
+            return img
+        size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    def _imencode(self, img: np.ndarray) -> bytes:
+        """Encode a grayscale image as JPEG"""
+        ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.JPEG_QUALITY,
+                                             cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        if not ok:
+            raise ValueError("JPEG encoding failed")
+        return buf.tobytes()
+
+    def _concat_grid(self, images: List[np.ndarray], cols: int, pad: int) -> Tuple[bytes, int, int]:
+        """
+        Tile several invoice images into a single grid image
+
+        Cells are sized so the whole grid fits within MAX_IMAGE_DIM; with
+        fewer images than columns, fewer columns (and so larger cells) are used.
 
-    def analyze_invoice(self, image_path: Path) -> Optional[Dict]:
+        Args:
+            images: Decoded invoices from _load_image, in reading order; the
+                grid is the only JPEG encode they go through
+            cols: Maximum number of grid columns
+            pad: White space between cells in pixels
+
+        Returns:
+            Tuple of (grid JPEG bytes, rows, columns)
+        """
+        cols = min(cols, len(images))
+        rows = -(-len(images) // cols)
+        cell_w = (self.MAX_IMAGE_DIM - pad * (cols - 1)) // cols
+        cell_h = (self.MAX_IMAGE_DIM - pad * (rows - 1)) // rows
+
+        cells = [self._fit(img, cell_w, cell_h) for img in images]
+
+        step_x = max(c.shape[1] for c in cells) + pad
+        step_y = max(c.shape[0] for c in cells) + pad
+        grid = np.full((step_y * rows - pad, step_x * cols - pad), 255, dtype=np.uint8)
+        for index, cell in enumerate(cells):
+            row, col = divmod(index, cols)
+            y, x = row * step_y, col * step_x
+            grid[y:y + cell.shape[0], x:x + cell.shape[1]] = cell
+
+        return self._imencode(grid), rows, cols
+
+    def _match_fields(self, match: re.Match) -> InvoiceRecord:
+        """Build an InvoiceRecord from an INVOICE_RE match"""
+        data = {
+            field: _unescape(match.group(field))
+            for field in self.INVOICE_FIELDS
+            if field not in ('items_found', 'total_amount')
+        }
+        amount = match.group('total_amount')
+        return InvoiceRecord(
+            **data,
+            items_found=[_unescape(item) for item in ITEM_RE.findall(match.group('items_found'))],
+            total_amount=_unescape(amount) if amount is not None else match.group('total_amount_num'),
+        )
+
+    @staticmethod
+    def _json_span(response_text: str, open_char: str, close_char: str) -> str:
+        """Slice out the outermost JSON value, dropping markdown fences or text around it"""
+        start = response_text.find(open_char)
+        end = response_text.rfind(close_char)
+        if start == -1 or end < start:
+            kind = 'object' if open_char == '{' else 'array'
+            raise msgspec.DecodeError(f"No JSON {kind} found in response")
+        return response_text[start:end + 1]
+
+    def _parse_response(self, response_text: str) -> InvoiceRecord:
+        """
+        Extract the invoice fields from Gemini's response
+
+        Well-formed responses are matched with INVOICE_RE in a single pass.
+        Anything else is decoded straight into an InvoiceRecord, which
+        rejects responses with missing or mistyped fields.
+
+        Args:
+            response_text: Raw response text from Gemini
+
+        Returns:
+            InvoiceRecord with the extracted fields
+        """
+        match = INVOICE_RE.search(response_text)
+        if match:
+            return self._match_fields(match)
+
+        return msgspec.json.decode(self._json_span(response_text, '{', '}'), type=_InvoiceJSON).to_record()
+
+    def _parse_grid_response(self, response_text: str, count: int) -> List[InvoiceRecord]:
+        """
+        Extract the invoice fields for every invoice in a grid response
+
+        Args:
+            response_text: Raw response text from Gemini
+            count: Number of invoices expected
+
+        Returns:
+            List of InvoiceRecords, in response order
+        """
+        matches = list(INVOICE_RE.finditer(response_text))
+        if len(matches) == count:
+            return [self._match_fields(match) for match in matches]
+
+        items = msgspec.json.decode(self._json_span(response_text, '[', ']'), type=List[_InvoiceJSON])
+        return [item.to_record() for item in items]
+
+    async def analyze_invoice_async(self, image_path: Path, image: Optional[bytes] = None) -> Optional[InvoiceRecord]:
         """
         Analyze a single invoice image
 
+        Uses the shared HTTP client while a processing run is active, and a
+        client opened just for this call otherwise.
+
         Args:
             image_path: Path to the invoice image
+            image: JPEG already prepared with _encode_image (loaded from
+                image_path if omitted)
 
         Returns:
-            Dictionary with extracted data or None if failed
+            InvoiceRecord with extracted data or None if failed
         """
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                logger.info(f"Processing: {image_path.name}")
+        logger.info(f"Processing: {image_path.name}")
+        response_text = ''
+        try:
+            # Load and shrink image off the event loop
+            if image is None:
+                image = await asyncio.to_thread(self._encode_image, image_path)
 
-                # Load image
-                image = Image.open(image_path)
+            response_text = await self._generate_async(self._prompt, image, self._estimated_tokens)
+            return self._invoice_result(image_path, response_text)
 
-                # Get prompt
-                prompt = self.get_prompt()
+        except Exception as e:
+            self._log_failure(image_path.name, e, response_text)
+            return None
 
-                # Call Gemini API
-                response = self.model.generate_content([prompt, image])
+    def analyze_invoice(self, image_path: Path) -> Optional[InvoiceRecord]:
+        """
+        Analyze a single invoice image without asyncio
 
-                # Parse response
-                response_text = response.text.strip()
+        Safe to call from several threads. Uses the shared HTTP client while
+        process_all_threaded is running, and a client opened just for this
+        call otherwise.
 
-                # Remove markdown code blocks if present
-                if response_text.startswith("```json"):
-                    response_text = response_text.replace("```json", "").replace("```", "").strip()
-                elif response_text.startswith("```"):
-                    response_text = response_text.replace("```", "").strip()
+        Args:
+            image_path: Path to the invoice image
 
-                # Parse JSON
-                data = json.loads(response_text)
+        Returns:
+            InvoiceRecord with extracted data or None if failed
+        """
+        logger.info(f"Processing: {image_path.name}")
+        response_text = ''
+        try:
+            image = self._encode_image(image_path)
+            response_text = self._generate(self._prompt, image, self._estimated_tokens)
+            return self._invoice_result(image_path, response_text)
 
-                # Add filename
-                data['invoice_file'] = image_path.name
+        except Exception as e:
+            self._log_failure(image_path.name, e, response_text)
+            return None
 
-                logger.info(f"[OK] Successfully processed: {image_path.name}")
-                logger.info(f"  Category: {data.get('category', 'Unknown')}")
-                logger.info(f"  Amount: ${data.get('total_amount', '0')}")
+    async def analyze_grid_async(self, image_paths: List[Path], images: List[np.ndarray]) -> Optional[List[InvoiceRecord]]:
+        """
+        Analyze several invoices with a single request by tiling them into a grid
 
-                return data
+        Args:
+            image_paths: Paths to the invoice images
+            images: Images already decoded with _load_image, same order
 
-            except ResourceExhausted as e:
-                if attempt < max_retries - 1:
-                    # Extract retry delay from the exception
-                    retry_delay = getattr(e, 'retry_delay', None)
-                    if retry_delay and hasattr(retry_delay, 'seconds'):
-                        delay = retry_delay.seconds
-                    else:
-                        delay = 60  # default 1 minute
-                    logger.warning(f"Quota exceeded, retrying in {delay} seconds... (attempt {attempt + 1}/{max_retries})")
-                    time.sleep(delay)
-                else:
-                    logger.error(f"[ERROR] Quota exceeded after {max_retries} attempts for {image_path.name}: {e}")
-                    return None
-            except json.JSONDecodeError as e:
-                logger.error(f"[ERROR] JSON parsing error for {image_path.name}: {e}")
-                logger.error(f"  Response: {response_text[:200]}")
-                return None
-            except Exception as e:
-                logger.error(f"[ERROR] Error processing {image_path.name}: {e}")
+        Returns:
+            List of InvoiceRecords in the same order, or
+            None if the request failed or did not return one result per invoice
+        """
+        names = ', '.join(path.name for path in image_paths)
+        logger.info(f"Processing grid: {names}")
+        response_text = ''
+        try:
+            grid, rows, cols = await asyncio.to_thread(
+                self._concat_grid, images, self.GRID_COLUMNS, self.GRID_PADDING
+            )
+            key = (len(images), rows, cols)
+            if key not in self._grid_prompts:
+                self._grid_prompts[key] = self.get_prompt(*key)
+            prompt = self._grid_prompts[key]
+
+            # Output grows with the number of invoices in the grid
+            estimated_tokens = len(prompt) // 4 + self.IMAGE_TOKEN_ESTIMATE * len(images)
+            response_text = await self._generate_async(prompt, grid, estimated_tokens)
+
+            results = self._parse_grid_response(response_text, len(images))
+            if len(results) != len(images):
+                logger.warning(f"Expected {len(images)} results for grid, got {len(results)}")
                 return None
 
-    def load_progress(self) -> List[str]:
-        """Load list of already processed files"""
-        if self.progress_file.exists():
-            with open(self.progress_file, 'r') as f:
-                progress = json.load(f)
-                logger.info(f"Resuming: {len(progress.get('processed', []))} files already processed")
-                return progress.get('processed', [])
-        return []
-
-    def save_progress(self, processed_files: List[str]):
-        """Save progress to file"""
-        with open(self.progress_file, 'w') as f:
-            json.dump({
-                'processed': processed_files,
-                'last_updated': datetime.now().isoformat()
-            }, f, indent=2)
-
-    def save_results(self):
-        """Save results to CSV"""
-        if not self.results:
-            logger.warning("No results to save")
+            for image_path, data in zip(image_paths, results):
+                data.invoice_file = image_path.name
+                self._log_success(data)
+
+            return results
+
+        except Exception as e:
+            self._log_failure(f"grid {names}", e, response_text)
+            return None
+
+    def _invoice_result(self, image_path: Path, response_text: str) -> InvoiceRecord:
+        """Parse the response for a single invoice and label it with its file"""
+        data = self._parse_response(response_text)
+        data.invoice_file = image_path.name
+        self._log_success(data)
+        return data
+
+    @staticmethod
+    def _log_success(data: InvoiceRecord):
+        """Log the key fields of a successfully parsed invoice"""
+        logger.info(f"[OK] Successfully processed: {data.invoice_file}")
+        logger.info(f"  Category: {data.category}")
+        logger.info(f"  Amount: ${data.total_amount}")
+
+    def _log_failure(self, label: str, error: Exception, response_text: str):
+        """Log why analyzing an invoice (or grid of invoices) failed"""
+        if isinstance(error, self.RETRYABLE_ERRORS):
+            logger.error(f"[ERROR] API error after {self.MAX_RETRIES} attempts for {label}: {error}")
+        elif isinstance(error, msgspec.DecodeError):
+            logger.error(f"[ERROR] JSON parsing error for {label}: {error}")
+            logger.error(f"  Response: {response_text[:200]}")
+        else:
+            logger.error(f"[ERROR] Error processing {label}: {error}")
+
+    def _build_request(self, prompt: str, image_data: bytes) -> Dict:
+        """Build a generateContent request body with the image inlined"""
+        return {
+            'contents': [{
+                'parts': [
+                    {'text': prompt},
+                    {'inline_data': {'mime_type': 'image/jpeg', 'data': base64.b64encode(image_data).decode('ascii')}}
+                ]
+            }]
+        }
+
+    @staticmethod
+    def _raise_for_status(response: httpx.Response):
+        """Raise the matching google.api_core exception for an API error response"""
+        if response.is_success:
             return
 
-        # Define CSV columns
-        fieldnames = [
-            'invoice_file', 'invoice_number', 'date', 'seller', 'client',
-            'category', 'confidence', 'items_found', 'reasoning', 'total_amount'
-        ]
+        try:
+            error = orjson.loads(response.content).get('error', {})
+        except orjson.JSONDecodeError:
+            error = {}
+        exc = api_exceptions.from_http_status(response.status_code, error.get('message', response.text))
+
+        # Keep the server's suggested wait (e.g. "37s") for _retry_wait
+        for detail in error.get('details', []):
+            if detail.get('@type', '').endswith('google.rpc.RetryInfo') and 'retryDelay' in detail:
+                exc.retry_delay = timedelta(seconds=float(detail['retryDelay'].rstrip('s')))
+        raise exc
+
+    @staticmethod
+    def _response_text(response: Dict) -> str:
+        """Return the text of the first candidate in a GenerateContentResponse"""
+        candidates = response.get('candidates') or [{}]
+        parts = candidates[0].get('content', {}).get('parts')
+        if not parts:
+            # Blocked prompts come back without candidates, and stopped
+            # candidates (safety, recitation, ...) without content
+            finish_reason = candidates[0].get('finishReason', 'none')
+            feedback = response.get('promptFeedback', 'none')
+            raise ValueError(f"Gemini returned no text (finishReason: {finish_reason}, promptFeedback: {feedback})")
+        return ''.join(part.get('text', '') for part in parts)
+
+    def _client_options(self) -> Dict:
+        """Keyword arguments for the shared httpx client of a processing run"""
+        return {
+            'http2': True,
+            'base_url': self.API_BASE_URL,
+            'timeout': self.REQUEST_TIMEOUT,
+            'headers': {'Content-Type': 'application/json'},
+            'limits': httpx.Limits(max_keepalive_connections=self.MAX_KEEPALIVE_CONNECTIONS),
+        }
+
+    def _retry_options(self, attempts: int) -> Dict:
+        """Keyword arguments for tenacity's Retrying/AsyncRetrying on transient API errors"""
+        return {
+            'retry': retry_if_exception_type(self.RETRYABLE_ERRORS),
+            'wait': self._retry_wait,
+            'stop': stop_after_attempt(attempts),
+            'before_sleep': self._log_retry,
+            'reraise': True,
+        }
+
+    def _generate_request(self, payload: bytes, key_index: int) -> Dict:
+        """Keyword arguments for posting a generateContent request with the given key"""
+        return {
+            'url': f"/v1beta/models/{self.MODEL_NAME}:generateContent",
+            'content': payload,
+            'headers': {'x-goog-api-key': self.api_keys[key_index]},
+        }
+
+    @asynccontextmanager
+    async def _async_client(self):
+        """Yield the run's shared async client, or a short-lived one outside a run"""
+        if self._http is not None:
+            yield self._http
+            return
+        async with httpx.AsyncClient(**self._client_options()) as client:
+            yield client
+
+    async def _generate_async(self, prompt: str, image_data: bytes, estimated_tokens: int) -> str:
+        """Call Gemini with the next API key in the rotation, retrying transient errors"""
+        payload = orjson.dumps(self._build_request(prompt, image_data))
+        async with self._async_client() as http:
+            async for attempt in AsyncRetrying(**self._retry_options(self.MAX_RETRIES)):
+                with attempt:
+                    key_index = next(self._rr)
+                    limiter = self.limiters[key_index]
+                    await limiter.acquire(estimated_tokens)
+                    response = await http.post(**self._generate_request(payload, key_index))
+                    self._raise_for_status(response)
+
+        return self._read_response(response, limiter, estimated_tokens)
+
+    @contextmanager
+    def _sync_client(self):
+        """Yield the run's shared blocking client, or a short-lived one outside a run"""
+        if self._http_sync is not None:
+            yield self._http_sync
+            return
+        with httpx.Client(**self._client_options()) as client:
+            yield client
+
+    def _generate(self, prompt: str, image_data: bytes, estimated_tokens: int) -> str:
+        """Blocking counterpart of _generate_async, used by worker threads"""
+        payload = orjson.dumps(self._build_request(prompt, image_data))
+        with self._sync_client() as http:
+            for attempt in Retrying(**self._retry_options(self.MAX_RETRIES)):
+                with attempt:
+                    key_index = next(self._rr)
+                    limiter = self.limiters[key_index]
+                    limiter.acquire_blocking(estimated_tokens)
+                    response = http.post(**self._generate_request(payload, key_index))
+                    self._raise_for_status(response)
+
+        return self._read_response(response, limiter, estimated_tokens)
+
+    def _read_response(self, response: httpx.Response, limiter: GeminiRateLimiter, estimated_tokens: int) -> str:
+        """Record the request's real token usage and return its text"""
+        data = orjson.loads(response.content)
+        usage = data.get('usageMetadata', {}).get('totalTokenCount')
+        if usage is not None:
+            limiter.record(usage, estimated_tokens)
+        return self._response_text(data)
+
+    def _retry_wait(self, retry_state: RetryCallState) -> float:
+        """
+        Delay before the next attempt
 
+        Uses the retry delay suggested by the API when there is one, otherwise
+        exponential backoff with full jitter so concurrent workers that failed
+        together do not retry together.
+        """
+        retry_delay = getattr(retry_state.outcome.exception(), 'retry_delay', None)
+        if retry_delay and hasattr(retry_delay, 'total_seconds'):
+            return min(self.MAX_RETRY_DELAY, retry_delay.total_seconds() + random.uniform(0, 1))
+        return self._backoff(retry_state)
+
+    def _log_retry(self, retry_state: RetryCallState):
+        """Log a retry before tenacity sleeps"""
+        error = retry_state.outcome.exception()
+        logger.warning(
+            f"{type(error).__name__}, retrying in {retry_state.next_action.sleep:.1f} seconds... "
+            f"(attempt {retry_state.attempt_number}/{self.MAX_RETRIES})"
+        )
+
+    def load_progress(self) -> Set[str]:
+        """Load the set of already processed files"""
+        processed_files = set()
+
+        # Progress saved by older versions as a single JSON document
+        legacy_file = self.output_folder / "progress.json"
+        if legacy_file.exists():
+            with open(legacy_file, 'rb') as f:
+                processed_files.update(orjson.loads(f.read()).get('processed', []))
+
+        if self.progress_file.exists():
+            with open(self.progress_file, 'rb') as f:
+                for line in f:
+                    try:
+                        processed_files.add(orjson.loads(line)['file'])
+                    except (orjson.JSONDecodeError, KeyError):
+                        # Skip blank lines or a line cut off by an interruption
+                        continue
+
+        if processed_files:
+            logger.info(f"Resuming: {len(processed_files)} files already processed")
+        return processed_files
+
+    def save_progress(self, file_name: str):
+        """Append a processed file to the progress log"""
+        with open(self.progress_file, 'ab') as f:
+            f.write(orjson.dumps({'file': file_name, 'ts': datetime.now().isoformat()}) + b'\n')
+
+    def load_batches(self) -> Dict[str, Dict]:
+        """Load batch jobs submitted by an earlier run that were never collected"""
+        if not self.batches_file.exists():
+            return {}
+        with open(self.batches_file, 'rb') as f:
+            batches = orjson.loads(f.read())
+        if batches:
+            logger.info(f"Resuming {len(batches)} submitted batch job(s)")
+        return batches
+
+    def save_batches(self, batches: Dict[str, Dict]):
+        """Record the batch jobs still waiting to be collected"""
+        tmp_file = self.batches_file.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(batches))
+        os.replace(tmp_file, self.batches_file)
+
+    @contextmanager
+    def _open_output(self):
+        """Keep the results CSV and result cache open for the duration of a run"""
         # Check if file exists and has content
         file_exists = os.path.exists(self.output_csv) and os.path.getsize(self.output_csv) > 0
 
-        # Write CSV in append mode
-        with open(self.output_csv, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
+        with open(self.output_csv, 'a', newline='', encoding='utf-8') as f, \
+                shelve.open(str(self.cache_file)) as cache:
+            self._csv_file = f
+            self._csv = csv.DictWriter(f, fieldnames=self.CSV_FIELDS)
+            self._cache = cache
             if not file_exists:
-                writer.writeheader()
+                self._csv.writeheader()
+            try:
+                yield
+            finally:
+                self._csv = None
+                self._csv_file = None
+                self._cache = None
+
+    @contextmanager
+    def _queued_logging(self):
+        """
+        Write log records from a background thread for the duration of a run
+
+        Workers only put records on a queue, so console and log file writes
+        never hold up a request. Stopping the listener drains the queue
+        before the usual handlers are put back.
+        """
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        queue_handler = QueueHandler(SimpleQueue())
+        listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        listener.start()
+        try:
+            yield
+        finally:
+            listener.stop()
+            root.removeHandler(queue_handler)
+            for handler in handlers:
+                root.addHandler(handler)
+
+    @staticmethod
+    def _file_digest(image_path: Path) -> str:
+        """SHA-256 of an image file's contents"""
+        with open(image_path, 'rb') as f:
+            if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+                return hashlib.file_digest(f, 'sha256').hexdigest()
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _cached_result(self, image_path: Path, digest: str) -> Optional[InvoiceRecord]:
+        """Return the saved result for an identical invoice, if there is one"""
+        cached = self._cache.get(digest)
+        if cached is None:
+            return None
+        try:
+            cached = msgspec.msgpack.decode(cached, type=InvoiceRecord)
+        except msgspec.DecodeError as e:  # Also covers ValidationError
+            # Treated as a miss, so the fresh result overwrites the entry
+            logger.warning(f"Ignoring unreadable cache entry for {image_path.name}: {e}")
+            return None
+        return self._copy_result(image_path, cached)
+
+    def _copy_result(self, image_path: Path, result: Optional[InvoiceRecord]) -> Optional[InvoiceRecord]:
+        """Reuse the result of an identical invoice under this file's name"""
+        if result is None:
+            return None
+        logger.info(f"[OK] {image_path.name} is a duplicate of {result.invoice_file}, reusing its result")
+        self.cached_count += 1
+        return msgspec.structs.replace(result, invoice_file=image_path.name)
+
+    def save_result(self, result: InvoiceRecord):
+        """Write a single result row to the open CSV"""
+        row = msgspec.structs.asdict(result)
+        # Convert items list to string
+        row['items_found'] = ', '.join(result.items_found)
+        self._csv.writerow(row)
+        self._csv_file.flush()
+
+    def process_all(self,
+                    max_files: Optional[int] = None,
+                    concurrency: Optional[int] = None,
+                    invoices_per_request: int = 1):
+        """
+        Process all invoice images in the input folder
+
+        Args:
+            max_files: Maximum number of files to process (None for all)
+            concurrency: Maximum number of in-flight Gemini requests
+                (defaults to CONCURRENCY per API key)
+            invoices_per_request: Invoices tiled into one image per request;
+                values above 1 cut the request count at the cost of
+                per-invoice resolution
+        """
+        if invoices_per_request < 1:
+            raise ValueError(f"invoices_per_request must be at least 1, got {invoices_per_request}")
+
+        remaining_files = self._get_remaining_files(max_files)
+        if remaining_files is None:
+            return
+
+        concurrency = concurrency or self.CONCURRENCY * len(self.api_keys)
+
+        self._log_run_header("Starting invoice processing", len(remaining_files), {
+            'API keys': len(self.api_keys),
+            'Concurrent requests': concurrency,
+            'Invoices per request': invoices_per_request,
+        }, requests=-(-len(remaining_files) // invoices_per_request))
 
-            for result in self.results:
-                # Convert items list to string
-                row = result.copy()
-                if isinstance(row.get('items_found'), list):
-                    row['items_found'] = ', '.join(row['items_found'])
-                writer.writerow(row)
+        start_time = time.time()
+
+        with self._open_output(), self._queued_logging():
+            asyncio.run(self._process_files_async(remaining_files, concurrency, invoices_per_request))
 
-        logger.info(f"[OK] Results saved to: {self.output_csv}")
+        self._log_summary(start_time)
 
-    def process_all(self, max_files: Optional[int] = None):
+    def process_all_threaded(self, max_files: Optional[int] = None, workers: int = 4):
         """
-        Process all invoice images in the input folder
+        Process all invoice images with a pool of worker threads
+
+        For callers that cannot run an asyncio event loop. Workers share one
+        HTTP client and the per-key rate limiters, so together they stay
+        within the same quota as process_all.
 
         Args:
             max_files: Maximum number of files to process (None for all)
+            workers: Number of worker threads
         """
-        # Get all image files
-        image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff'}
-        image_files = [
-            f for f in self.input_folder.iterdir()
-            if f.is_file() and f.suffix.lower() in image_extensions
-        ]
+        remaining_files = self._get_remaining_files(max_files)
+        if remaining_files is None:
+            return
+
+        total_files = len(remaining_files)
+        self._log_run_header("Starting invoice processing", total_files, {
+            'API keys': len(self.api_keys),
+            'Worker threads': workers,
+        }, requests=total_files)
+
+        start_time = time.time()
+
+        with self._open_output(), self._queued_logging(), httpx.Client(**self._client_options()) as client:
+            self._http_sync = client
+            try:
+                # Duplicates are resolved up front; results are written from
+                # this thread only, so the CSV, cache and progress log need no lock
+                pending = []
+                later_copies: Dict[str, List[Path]] = {}
+                completed = 0
+
+                def finish(image_file: Path, result: Optional[InvoiceRecord], digest: Optional[str] = None):
+                    nonlocal completed
+                    completed += 1
+                    logger.info(f"[{completed}/{total_files}] Finished {image_file.name}")
+                    self._record_result(image_file.name, result, digest)
+                    for copy in later_copies.pop(digest, ()):
+                        finish(copy, self._copy_result(copy, result))
+
+                for image_file in remaining_files:
+                    try:
+                        digest = self._file_digest(image_file)
+                        cached = self._cached_result(image_file, digest)
+                    except Exception as e:
+                        logger.error(f"[ERROR] Error reading {image_file.name}: {e}")
+                        finish(image_file, None)
+                        continue
+                    if cached:
+                        finish(image_file, cached)
+                    elif digest in later_copies:
+                        later_copies[digest].append(image_file)
+                    else:
+                        later_copies[digest] = []
+                        pending.append((image_file, digest))
+
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = executor.map(self.analyze_invoice, [image_file for image_file, _ in pending])
+                    for (image_file, digest), result in zip(pending, results):
+                        finish(image_file, result, digest)
+            finally:
+                self._http_sync = None
+
+        self._log_summary(start_time)
+
+    def _get_remaining_files(self, max_files: Optional[int]) -> Optional[List[Path]]:
+        """
+        Find invoice images that have not been processed yet
+
+        Args:
+            max_files: Maximum number of files to return (None for all)
+
+        Returns:
+            List of files to process, or None if the input folder has no images
+        """
+        # Get all image files (scandir reuses the directory listing's file
+        # type instead of a stat() per entry)
+        image_extensions = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff'}
+        with os.scandir(self.input_folder) as entries:
+            image_files = [
+                Path(entry.path) for entry in entries
+                if entry.is_file() and entry.name.rpartition('.')[2].lower() in image_extensions
+            ]
 
         if not image_files:
             logger.error(f"No image files found in {self.input_folder}")
-            return
+            return None
 
         # Load progress
         processed_files = self.load_progress()
@@ -283,49 +1072,368 @@ Respond ONLY with valid JSON, no additional text."""
         if max_files:
             remaining_files = remaining_files[:max_files]
 
-        total_files = len(remaining_files)
+        return remaining_files
+
+    def _log_run_header(self,
+                        title: str,
+                        total_files: int,
+                        details: Optional[Dict[str, object]] = None,
+                        requests: Optional[int] = None):
+        """
+        Log the banner at the start of a processing run
+
+        Args:
+            title: First line of the banner
+            total_files: Number of files the run will process
+            details: Extra "label: value" lines for the mode in use
+            requests: Number of rate-limited requests, to estimate the run
+                time from (omitted for modes without rate limits)
+        """
         logger.info(f"\n{'='*60}")
-        logger.info(f"Starting invoice processing")
+        logger.info(title)
         logger.info(f"Total files to process: {total_files}")
-        logger.info(f"Estimated time: {total_files * self.DELAY_BETWEEN_REQUESTS / 60:.1f} minutes")
+        for label, value in (details or {}).items():
+            logger.info(f"{label}: {value}")
+        if requests is not None:
+            logger.info(f"Estimated time: {requests / (self.REQUESTS_PER_MINUTE * len(self.api_keys)):.1f} minutes")
         logger.info(f"{'='*60}\n")
 
-        start_time = time.time()
-
-        # Process each file
-        for idx, image_file in enumerate(remaining_files, 1):
-            logger.info(f"\n[{idx}/{total_files}] Processing {image_file.name}")
-
-            # Analyze invoice
-            result = self.analyze_invoice(image_file)
-
-            if result:
-                self.results.append(result)
-                processed_files.append(image_file.name)
-                self.processed_count += 1
-            else:
-                self.failed_count += 1
-
-            # Save progress after each file
-            self.save_progress(processed_files)
-            self.save_results()
-
-            # Rate limiting for free tier
-            if idx < total_files:  # Don't delay after last file
-                logger.info(f"[WAIT] Waiting {self.DELAY_BETWEEN_REQUESTS:.1f}s (rate limiting)...")
-                time.sleep(self.DELAY_BETWEEN_REQUESTS)
-
-        # Final summary
+    def _log_summary(self, start_time: float):
+        """Log the final processing summary"""
         elapsed_time = time.time() - start_time
         logger.info(f"\n{'='*60}")
         logger.info(f"Processing Complete!")
         logger.info(f"{'='*60}")
         logger.info(f"[OK] Successfully processed: {self.processed_count}")
         logger.info(f"[ERROR] Failed: {self.failed_count}")
+        logger.info(f"[CACHE] Duplicates reused: {self.cached_count}")
         logger.info(f"[TIME] Total time: {elapsed_time / 60:.1f} minutes")
         logger.info(f"[FILE] Output file: {self.output_csv}")
         logger.info(f"{'='*60}\n")
 
+    async def _process_files_async(self, files: List[Path], concurrency: int, invoices_per_request: int = 1):
+        """
+        Analyze files concurrently, saving each result as it completes
+
+        A producer loads and shrinks images into a bounded queue, in groups
+        of `invoices_per_request`, while `concurrency` consumers send them to
+        Gemini, so disk reads and image decoding overlap with requests
+        already in flight.
+        """
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        # Grids are tiled from decoded images so each invoice is JPEG-encoded
+        # only once, as part of the grid
+        load_image = self._load_image if invoices_per_request > 1 else self._encode_image
+        total_files = len(files)
+        completed = 0
+
+        # One HTTP/2 connection pool shared by every consumer, so requests
+        # reuse connections instead of paying a TLS handshake each
+        self._http = httpx.AsyncClient(**self._client_options())
+
+        # Copies of an invoice that is already queued, by content digest;
+        # they take the first copy's result instead of a request of their own
+        later_copies: Dict[str, List[Path]] = {}
+
+        def finish(image_file: Path, result: Optional[InvoiceRecord], digest: Optional[str] = None):
+            nonlocal completed
+            completed += 1
+            logger.info(f"[{completed}/{total_files}] Finished {image_file.name}")
+            self._record_result(image_file.name, result, digest)
+            for copy in later_copies.pop(digest, ()):
+                finish(copy, self._copy_result(copy, result))
+
+        async def producer():
+            group = []
+            for image_file in files:
+                digest = None
+                try:
+                    digest = await asyncio.to_thread(self._file_digest, image_file)
+                    cached = self._cached_result(image_file, digest)
+                    if cached:
+                        finish(image_file, cached)
+                        continue
+                    if digest in later_copies:
+                        later_copies[digest].append(image_file)
+                        continue
+                    later_copies[digest] = []
+                    image = await asyncio.to_thread(load_image, image_file)
+                except Exception as e:
+                    logger.error(f"[ERROR] Error reading {image_file.name}: {e}")
+                    finish(image_file, None, digest)
+                    continue
+                group.append((image_file, image, digest))
+                if len(group) == invoices_per_request:
+                    await queue.put(group)
+                    group = []
+            if group:
+                await queue.put(group)
+
+            # One stop signal per consumer
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def jpeg(image):
+            # Grid mode queues decoded images; one sent on its own is encoded here
+            if isinstance(image, np.ndarray):
+                return await asyncio.to_thread(self._imencode, image)
+            return image
+
+        async def consumer():
+            while True:
+                group = await queue.get()
+                if group is None:
+                    break
+
+                if len(group) == 1:
+                    image_file, image, digest = group[0]
+                    finish(image_file, await self.analyze_invoice_async(image_file, await jpeg(image)), digest)
+                    continue
+
+                results = await self.analyze_grid_async(
+                    [image_file for image_file, _, _ in group],
+                    [image for _, image, _ in group]
+                )
+                if results is None:
+                    # Fall back to one request per invoice
+                    results = [await self.analyze_invoice_async(f, await jpeg(image)) for f, image, _ in group]
+                for (image_file, _, digest), result in zip(group, results):
+                    finish(image_file, result, digest)
+
+        try:
+            await asyncio.gather(producer(), *(consumer() for _ in range(concurrency)))
+        finally:
+            await self._http.aclose()
+            self._http = None
+
+    def _record_result(self, file_name: str, result: Optional[InvoiceRecord], digest: Optional[str] = None):
+        """Save a successful result and mark its file processed, or count a failure"""
+        if result:
+            if digest is not None:
+                # Stored as msgpack rather than a pickled InvoiceRecord, so the
+                # cache reads back the same whether this file ran as a script
+                # (__main__) or was imported
+                self._cache[digest] = msgspec.msgpack.encode(result)
+            self.save_result(result)
+            self.save_progress(file_name)
+            self.processed_count += 1
+        else:
+            self.failed_count += 1
+
+    def process_all_batch(self, max_files: Optional[int] = None):
+        """
+        Process all invoice images through the Gemini Batch API
+
+        Submits every remaining invoice as inline batch requests and polls
+        until the jobs finish. Batch jobs are billed at half price and are
+        not subject to the interactive rate limits, but may take much longer
+        to complete, so this suits unattended runs over a whole folder.
+        Submitted jobs are saved to batches.json until their results are
+        written, so an interrupted run collects them on its next start
+        instead of submitting them again.
+
+        Args:
+            max_files: Maximum number of files to process (None for all)
+        """
+        remaining_files = self._get_remaining_files(max_files)
+        if remaining_files is None:
+            return
+
+        # Jobs from an interrupted run are collected instead of resubmitted
+        batches = self.load_batches()
+        submitted = {
+            name
+            for job in batches.values()
+            for name in itertools.chain(job['files'], *job['copies'].values())
+        }
+        remaining_files = [f for f in remaining_files if f.name not in submitted]
+        # Files a resumed job already wrote before the interruption
+        processed_files = self.load_progress() if batches else set()
+
+        if not batches and len(remaining_files) < self.BATCH_MIN_FILES:
+            logger.info(f"Fewer than {self.BATCH_MIN_FILES} files, using regular mode instead of batch")
+            self.process_all(max_files=max_files)
+            return
+
+        self._log_run_header("Starting batch invoice processing", len(remaining_files) + len(submitted))
+
+        start_time = time.time()
+
+        with self._open_output(), self._queued_logging():
+            # Fill one job at a time and submit it once the next request
+            # would take it over the inline size limit, so only a single
+            # job's encoded images are held in memory
+            prompt = self._prompt
+            requests, files, job_bytes = [], {}, 0  # files: {file name: digest}
+            later_copies: Dict[str, List[str]] = {}
+            for image_file in remaining_files:
+                try:
+                    digest = self._file_digest(image_file)
+                    cached = self._cached_result(image_file, digest)
+                    if cached:
+                        self._record_result(image_file.name, cached)
+                        continue
+                    if digest in later_copies:
+                        later_copies[digest].append(image_file.name)
+                        if digest not in files.values():
+                            # Its first copy went out with an earlier job
+                            self.save_batches(batches)
+                        continue
+                    image_data = self._encode_image(image_file)
+                except Exception as e:
+                    logger.error(f"[ERROR] Error reading {image_file.name}: {e}")
+                    self.failed_count += 1
+                    continue
+                later_copies[digest] = []
+
+                request = {
+                    'request': self._build_request(prompt, image_data),
+                    'metadata': {'key': image_file.name}
+                }
+                request_bytes = len(orjson.dumps(request)) + 1  # plus the separating comma
+                if requests and job_bytes + request_bytes > self.BATCH_MAX_BYTES - self.BATCH_ENVELOPE_BYTES:
+                    self._submit_job(batches, requests, files, later_copies)
+                    requests, files, job_bytes = [], {}, 0
+                requests.append(request)
+                files[image_file.name] = digest
+                job_bytes += request_bytes
+
+            if requests:
+                self._submit_job(batches, requests, files, later_copies)
+
+            for batch_name, job in list(batches.items()):
+                self._collect_batch(batch_name, job, processed_files)
+                del batches[batch_name]
+                self.save_batches(batches)
+
+        self._log_summary(start_time)
+
+    def _submit_job(self,
+                    batches: Dict[str, Dict],
+                    requests: List[Dict],
+                    files: Dict[str, str],
+                    later_copies: Dict[str, List[str]]):
+        """
+        Submit one batch job and save it to batches.json straight away
+
+        An interrupted run can then collect the job instead of paying for
+        it twice. The job shares its copy lists with later_copies, so copies
+        found after submission are saved with it too.
+
+        Args:
+            batches: Submitted jobs by name, updated in place
+            requests: Inline requests for the job
+            files: Files in the job ({file name: digest})
+            later_copies: Duplicate file names by digest
+        """
+        copies = {digest: later_copies[digest] for digest in files.values()}
+        batches[self._submit_batch(requests)] = {'files': files, 'copies': copies}
+        self.save_batches(batches)
+
+    def _collect_batch(self, batch_name: str, job: Dict, processed_files: Set[str]):
+        """
+        Wait for a batch job and record the result of every file in it
+
+        Args:
+            batch_name: Name of the batch job
+            job: Files in the job ({file name: digest}) and their later
+                copies ({digest: [file name, ...]})
+            processed_files: Files already recorded, which are skipped
+        """
+        batch = self._wait_for_batch(batch_name)
+        responses = self._batch_responses(batch) if batch is not None else []
+
+        # Files the job has no response for, e.g. because it failed or
+        # expired, are counted as failed and retried on the next run
+        answered = {file_name for file_name, _ in responses}
+        for file_name, digest in job['files'].items():
+            if file_name not in answered:
+                for name in [file_name] + job['copies'].get(digest, []):
+                    if name not in processed_files:
+                        self._record_result(name, None)
+
+        for file_name, response in responses:
+            if file_name in processed_files:
+                continue
+            result = None
+            try:
+                if 'error' in response:
+                    raise RuntimeError(response['error'].get('message', response['error']))
+                result = self._parse_response(self._response_text(response['response']))
+                result.invoice_file = file_name
+                logger.info(f"[OK] Successfully processed: {file_name}")
+            except Exception as e:
+                logger.error(f"[ERROR] Error processing {file_name}: {e}")
+            digest = job['files'].get(file_name)
+            self._record_result(file_name, result, digest)
+            for copy in job['copies'].get(digest, ()):
+                if copy not in processed_files:
+                    self._record_result(copy, self._copy_result(Path(copy), result))
+
+    def _api_request(self, method: str, path: str, payload: Optional[Dict] = None) -> bytes:
+        """
+        Send an authenticated request to the Gemini REST API
+
+        GET requests (batch polls and result downloads) are retried on
+        transient errors. Other requests are sent once, since repeating a
+        batch submission could create a second billed job.
+        """
+        for attempt in Retrying(**self._retry_options(self.MAX_RETRIES if method == 'GET' else 1)):
+            with attempt:
+                response = httpx.request(
+                    method,
+                    f"{self.API_BASE_URL}/{path}",
+                    content=orjson.dumps(payload) if payload is not None else None,
+                    headers={'x-goog-api-key': self.api_keys[0], 'Content-Type': 'application/json'},
+                    timeout=300
+                )
+                self._raise_for_status(response)
+        return response.content
+
+    def _submit_batch(self, requests: List[Dict]) -> str:
+        """Create a batch job for the given inline requests and return its name"""
+        payload = {
+            'batch': {
+                'display_name': f"invoices-{datetime.now():%Y%m%d-%H%M%S}",
+                'input_config': {'requests': {'requests': requests}}
+            }
+        }
+        batch = orjson.loads(self._api_request(
+            'POST', f"v1beta/models/{self.MODEL_NAME}:batchGenerateContent", payload
+        ))
+        logger.info(f"Submitted batch {batch['name']} with {len(requests)} invoices")
+        return batch['name']
+
+    def _wait_for_batch(self, batch_name: str) -> Optional[Dict]:
+        """Poll a batch job until it finishes; return it, or None if it failed"""
+        while True:
+            batch = orjson.loads(self._api_request('GET', f"v1beta/{batch_name}"))
+            state = batch.get('metadata', {}).get('state', '')
+            if batch.get('done') or state.endswith(('SUCCEEDED', 'FAILED', 'CANCELLED', 'EXPIRED')):
+                break
+            logger.info(f"[WAIT] Batch {batch_name} is {state or 'pending'}, checking again in {self.BATCH_POLL_INTERVAL}s...")
+            time.sleep(self.BATCH_POLL_INTERVAL)
+
+        if not state.endswith('SUCCEEDED'):
+            logger.error(f"[ERROR] Batch {batch_name} ended with state {state}: {batch.get('error')}")
+            return None
+        return batch
+
+    def _batch_responses(self, batch: Dict) -> List[Tuple[str, Dict]]:
+        """Return (file name, response) pairs from a finished batch job"""
+        output = batch.get('response', {})
+
+        if 'responsesFile' in output:
+            # Large results are written to a JSONL file instead of inline
+            content = self._api_request('GET', f"download/v1beta/{output['responsesFile']}:download?alt=media")
+            entries = [orjson.loads(line) for line in content.splitlines() if line.strip()]
+            return [(entry['key'], entry) for entry in entries]
+
+        entries = output.get('inlinedResponses', {})
+        if isinstance(entries, dict):
+            entries = entries.get('inlinedResponses', [])
+        return [(entry.get('metadata', {}).get('key', ''), entry) for entry in entries]
+
 
 def main():
     """Main entry point"""
@@ -333,16 +1441,19 @@ def main():
     print("Invoice Processing System - Gemini API (Free Tier)")
     print("="*60 + "\n")
 
-    # Get API key
-    api_key = os.getenv('GEMINI_API_KEY')
+    # Get API keys (GEMINI_API_KEYS holds a comma-separated list)
+    api_keys = [k.strip() for k in os.getenv('GEMINI_API_KEYS', '').split(',') if k.strip()]
+    if not api_keys and os.getenv('GEMINI_API_KEY'):
+        api_keys = [os.getenv('GEMINI_API_KEY')]
 
-    if not api_key:
-        print("⚠️  GEMINI_API_KEY not found in environment variables")
+    if not api_keys:
+        print("⚠️  GEMINI_API_KEYS / GEMINI_API_KEY not found in environment variables")
         api_key = input("Please enter your Gemini API key: ").strip()
 
         if not api_key:
             print("❌ API key is required. Exiting...")
             return
+        api_keys = [api_key]
 
     # Configuration
     input_folder = "invoices"
@@ -356,9 +1467,13 @@ def main():
     test_mode = input("\nTest mode (process only first 5 files)? [y/N]: ").strip().lower()
     max_files = 5 if test_mode == 'y' else None
 
+    batch_mode = False
+    if not max_files:
+        batch_mode = input("Use Batch API (half price, results may take hours)? [y/N]: ").strip().lower() == 'y'
+
     # Create processor
     processor = InvoiceProcessor(
-        api_key=api_key,
+        api_keys=api_keys,
         input_folder=input_folder,
         output_folder=output_folder
     )
@@ -374,7 +1489,10 @@ def main():
     confirm = input("\nPress ENTER to start or Ctrl+C to cancel...")
 
     # Process
-    processor.process_all(max_files=max_files)
+    if batch_mode:
+        processor.process_all_batch(max_files=max_files)
+    else:
+        processor.process_all(max_files=max_files)
 
 
 if __name__ == "__main__":